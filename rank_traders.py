@@ -30,7 +30,6 @@ from pathlib import Path
 from string import Template
 from typing import Any
 
-import requests
 import trades
 from trades import MarketAttribute, MarketState, wei_to_xdai
 
@@ -48,15 +47,9 @@ ENV_FILE = Path(STORE_PATH, ".env")
 load_dotenv(ENV_FILE)
 
 
-headers = {
-    "Accept": "application/json, multipart/mixed",
-    "Content-Type": "application/json",
-}
-
-
 omen_xdai_trades_query = Template(
     """
-    {
+    query Trades($$id_gt: ID!) {
         fpmmTrades(
             where: {
                 type: Buy,
@@ -67,7 +60,7 @@ omen_xdai_trades_query = Template(
                 },
                 creationTimestamp_gte: "${creationTimestamp_gte}",
                 creationTimestamp_lte: "${creationTimestamp_lte}"
-                id_gt: "${id_gt}"
+                id_gt: $$id_gt
             }
             first: ${first}
             orderBy: id
@@ -75,28 +68,20 @@ omen_xdai_trades_query = Template(
         ) {
             id
             title
-            collateralToken
-            outcomeTokenMarginalPrice
-            oldOutcomeTokenMarginalPrice
-            type
             creator {
                 id
             }
             creationTimestamp
             collateralAmount
-            collateralAmountUSD
             feeAmount
             outcomeIndex
             outcomeTokensTraded
-            transactionHash
             fpmm {
                 id
                 outcomes
-                title
                 answerFinalizedTimestamp
                 currentAnswer
                 isPendingArbitration
-                arbitrationOccurred
                 openingTimestamp
                 condition {
                     id
@@ -158,11 +143,11 @@ def _parse_args() -> Any:
     return args
 
 
-def _to_content(q: str) -> dict[str, Any]:
+def _to_content(q: str, variables: dict[str, Any] | None = None) -> dict[str, Any]:
     """Convert the given query string to payload content, i.e., add it under a `queries` key and convert it to bytes."""
     finalized_query = {
         "query": q,
-        "variables": None,
+        "variables": variables,
         "extensions": {"headers": None},
     }
     return finalized_query
@@ -178,44 +163,31 @@ def _query_omen_xdai_subgraph(
     subgraph_api_key = os.getenv('SUBGRAPH_API_KEY')
     url = f"https://gateway-arbitrum.network.thegraph.com/api/{subgraph_api_key}/subgraphs/id/9fUVQpFwzpdWS9bq5WkAnmKbNNcoBwatMR4yZq81pbbz"
 
-    grouped_results = defaultdict(list)
+    all_trades: list[dict[str, Any]] = []
     id_gt = ""
 
+    # Rendered once; only the cursor changes from one page to the next.
+    query = omen_xdai_trades_query.substitute(
+        fpmm_creator=FPMM_CREATOR.lower(),
+        creationTimestamp_gte=int(from_timestamp),
+        creationTimestamp_lte=int(to_timestamp),
+        fpmm_creationTimestamp_gte=int(fpmm_from_timestamp),
+        fpmm_creationTimestamp_lte=int(fpmm_to_timestamp),
+        first=QUERY_BATCH_SIZE,
+    )
+
     while True:
-        query = omen_xdai_trades_query.substitute(
-            fpmm_creator=FPMM_CREATOR.lower(),
-            creationTimestamp_gte=int(from_timestamp),
-            creationTimestamp_lte=int(to_timestamp),
-            fpmm_creationTimestamp_gte=int(fpmm_from_timestamp),
-            fpmm_creationTimestamp_lte=int(fpmm_to_timestamp),
-            first=QUERY_BATCH_SIZE,
-            id_gt=id_gt,
-        )
-        content_json = _to_content(query)
-        res = requests.post(url, headers=headers, json=content_json)
-        result_json = res.json()
+        content_json = _to_content(query, {"id_gt": id_gt})
+        result_json = trades._post_query(url, content_json)
         user_trades = result_json.get("data", {}).get("fpmmTrades", [])
 
         if not user_trades:
             break
 
-        for trade in user_trades:
-            fpmm_id = trade.get("fpmm", {}).get("id")
-            grouped_results[fpmm_id].append(trade)
-
+        all_trades.extend(user_trades)
         id_gt = user_trades[len(user_trades) - 1]["id"]
 
-    all_results = {
-        "data": {
-            "fpmmTrades": [
-                trade
-                for trades_list in grouped_results.values()
-                for trade in trades_list
-            ]
-        }
-    }
-
-    return all_results
+    return {"data": {"fpmmTrades": all_trades}}
 
 
 def _group_trades_by_creator(trades_json: dict[str, Any]) -> dict[str, Any]:
@@ -270,7 +242,7 @@ def _print_user_summary(
         "\n",
     ]
 
-    output = "".join(titles)
+    parts = ["".join(titles)]
     for user_id, statistics_table in sorted_users:
         values = [
             user_id,
@@ -285,9 +257,9 @@ def _print_user_summary(
             f"{statistics_table[MarketAttribute.ROI][state] * 100.0:7.2f}%".rjust(9),
             "\n",
         ]
-        output += "".join(values)
+        parts.append("".join(values))
 
-    print(output)
+    print("".join(parts))
 
 
 def _print_progress_bar(  # pylint: disable=too-many-arguments
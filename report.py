@@ -38,7 +38,7 @@ from trades import (
     MarketAttribute,
     MarketState,
     get_balance,
-    get_token_balance,
+    get_balances,
     wei_to_olas,
     wei_to_unit,
     wei_to_wxdai,
@@ -465,8 +465,9 @@ if __name__ == "__main__":
     )
 
     # Safe
-    safe_xdai = get_balance(safe_address, rpc)
-    safe_wxdai = get_token_balance(safe_address, trades.WXDAI_CONTRACT_ADDRESS, rpc)
+    safe_xdai, safe_wxdai = get_balances(
+        safe_address, trades.WXDAI_CONTRACT_ADDRESS, rpc
+    )
     _print_subsection_header(
         f"Safe {_warning_message(safe_xdai + safe_wxdai, SAFE_BALANCE_THRESHOLD)}"
     )
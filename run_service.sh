@@ -919,7 +919,7 @@ then
     poetry run autonomy packages sync
     poetry run autonomy init --reset --author $open_autonomy_author --remote --ipfs --ipfs-node "/dns/registry.autonolas.tech/tcp/443/https"
     # temporarily pinning cryptography to `42.0.8` to address https://github.com/paramiko/paramiko/issues/2419
-    poetry add tqdm cryptography==42.0.8
+    poetry add tqdm orjson cryptography==42.0.8
 else
     echo "$directory is not a git repo!"
     exit 1
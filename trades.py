@@ -21,34 +21,90 @@
 """This script queries the OMEN subgraph to obtain the trades of a given address."""
 
 import datetime
+import functools
+import hashlib
+import itertools
+import json
 import os
 import re
+import tempfile
+import time
 from argparse import Action, ArgumentError, ArgumentParser, Namespace
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from dotenv import load_dotenv
 from enum import Enum
 from pathlib import Path
-from string import Template
-from typing import Any, Dict, Optional
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
 
 from scripts.mech_events import get_mech_requests
 
 
-IRRELEVANT_TOOLS = [
-    "openai-text-davinci-002",
-    "openai-text-davinci-003",
-    "openai-gpt-3.5-turbo",
-    "openai-gpt-4",
-    "stabilityai-stable-diffusion-v1-5",
-    "stabilityai-stable-diffusion-xl-beta-v2-2-2",
-    "stabilityai-stable-diffusion-512-v2-1",
-    "stabilityai-stable-diffusion-768-v2-1",
-    "deepmind-optimization-strong",
-    "deepmind-optimization",
-]
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads  # type: ignore
+
+    def _json_dumps(obj: Any) -> bytes:  # type: ignore
+        return json.dumps(obj).encode()
+
+
+IRRELEVANT_TOOLS = frozenset(
+    [
+        "openai-text-davinci-002",
+        "openai-text-davinci-003",
+        "openai-gpt-3.5-turbo",
+        "openai-gpt-4",
+        "stabilityai-stable-diffusion-v1-5",
+        "stabilityai-stable-diffusion-xl-beta-v2-2-2",
+        "stabilityai-stable-diffusion-512-v2-1",
+        "stabilityai-stable-diffusion-768-v2-1",
+        "deepmind-optimization-strong",
+        "deepmind-optimization",
+    ]
+)
+WEI_IN_UNIT = 10**18
+ETHEREUM_ADDRESS_REGEX = re.compile(r"0x[a-fA-F0-9]{40}")
+QUOTED_TEXT_REGEX = re.compile(r"\"(.*)\"")
 QUERY_BATCH_SIZE = 1000
+# Consecutive pages requested under aliases in a single query; TheGraph rejects a skip above 5000.
+QUERY_BATCH_PAGES = 5
+# Trade ids are hex strings, so these prefixes split them into ranges of similar sizes that are paged
+# concurrently; "0y" sorts after any "0x" id.
+QUERY_ID_RANGE_BOUNDS = ("", "0x4", "0x8", "0xc", "0y")
+HTTP_POOL_CONNECTIONS = 16
+HTTP_POOL_MAXSIZE = 32
+HTTP_MAX_RETRIES = 5
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+HTTP_TIMEOUT = 60
+# The trades batch size is halved down to this size on failed or slow (in seconds) responses,
+# and doubled back up to QUERY_BATCH_SIZE after two consecutive fast ones.
+QUERY_MIN_BATCH_SIZE = 100
+QUERY_SLOW_RESPONSE_TIME = 8.0
+QUERY_FAST_RESPONSE_TIME = 1.0
+# Trades younger than this (in seconds), or than the latest block indexed by the subgraph, are not stored or cached.
+TRADES_STORE_INDEXING_MARGIN = 3600
+# Cached subgraph responses older than this (in seconds) are discarded.
+SUBGRAPH_CACHE_MAX_AGE = 30 * 24 * 60 * 60
 DUST_THRESHOLD = 10000000000000
 INVALID_ANSWER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
 FPMM_CREATOR = "0x89c5cc945dd550bcffb72fe42bff002429f46fec"
@@ -61,9 +117,9 @@ STORE_PATH = Path(SCRIPT_PATH, ".trader_runner")
 RPC_PATH = Path(STORE_PATH, "rpc.txt")
 ENV_FILE = Path(STORE_PATH, ".env")
 WXDAI_CONTRACT_ADDRESS = "0xe91D153E0b41518A2Ce8Dd3D7944Fa863463a97d"
-SCRIPT_PATH = Path(__file__).resolve().parent
-STORE_PATH = Path(SCRIPT_PATH, ".trader_runner")
 SAFE_ADDRESS_PATH = Path(STORE_PATH, "service_safe_address.txt")
+SUBGRAPH_CACHE_PATH = Path(STORE_PATH, "subgraph_cache")
+TRADES_STORE_PATH = Path(STORE_PATH, "trades")
 
 
 load_dotenv(ENV_FILE)
@@ -72,88 +128,137 @@ load_dotenv(ENV_FILE)
 headers = {
     "Accept": "application/json, multipart/mixed",
     "Content-Type": "application/json",
+    # gzip and deflate, plus brotli and zstd when their decoders are installed
+    "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"],
 }
 
 
-omen_xdai_trades_query = Template(
+def _make_session(retry_read_errors: bool = True) -> requests.Session:
+    """Create a session with pooled connections that retries rate limited and failed requests."""
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS,
+            pool_maxsize=HTTP_POOL_MAXSIZE,
+            max_retries=Retry(
+                total=HTTP_MAX_RETRIES,
+                read=None if retry_read_errors else False,
+                backoff_factor=HTTP_BACKOFF_FACTOR,
+                status_forcelist=HTTP_RETRY_STATUS_CODES,
+                allowed_methods=frozenset(["POST"]),
+                respect_retry_after_header=True,
+            ),
+        ),
+    )
+    return session
+
+
+_SESSION = _make_session()
+# Timed out trade pages are not sent again as they are, but retried with smaller pages.
+_TRADES_SESSION = _make_session(retry_read_errors=False)
+# Runs subgraph requests in the background, so that they overlap with each other and with parsing.
+_EXECUTOR = ThreadPoolExecutor(max_workers=HTTP_POOL_CONNECTIONS)
+
+
+omen_xdai_trades_query = """
+    query Trades($id_gt: ID!) {{
+{pages}
+        _meta {{
+            block {{
+                timestamp
+            }}
+        }}
+    }}
     """
-    {
-        fpmmTrades(
-            where: {
+
+
+omen_xdai_trades_page_query = """
+        page{page}: fpmmTrades(
+            where: {{
                 type: Buy,
-                creator: "${creator}",
-                fpmm_: {
-                    creator: "${fpmm_creator}"
-                    creationTimestamp_gte: "${fpmm_creationTimestamp_gte}",
-                    creationTimestamp_lt: "${fpmm_creationTimestamp_lte}"
-                },
-                creationTimestamp_gte: "${creationTimestamp_gte}",
-                creationTimestamp_lte: "${creationTimestamp_lte}"
-                creationTimestamp_gt: "${creationTimestamp_gt}"
-            }
-            first: ${first}
-            orderBy: creationTimestamp
+                creator: "{creator}",
+                fpmm_: {{
+                    creator: "{fpmm_creator}"
+                    creationTimestamp_gte: "{fpmm_creationTimestamp_gte}",
+                    creationTimestamp_lt: "{fpmm_creationTimestamp_lte}"
+                }},
+                creationTimestamp_gte: "{creationTimestamp_gte}",
+                creationTimestamp_lte: "{creationTimestamp_lte}"
+                id_gt: $id_gt
+                id_lt: "{id_lt}"
+            }}
+            first: {first}
+            skip: {skip}
+            orderBy: id
             orderDirection: asc
-        ) {
+        ) {{
             id
             title
-            collateralToken
-            outcomeTokenMarginalPrice
-            oldOutcomeTokenMarginalPrice
-            type
-            creator {
-                id
-            }
             creationTimestamp
             collateralAmount
-            collateralAmountUSD
             feeAmount
             outcomeIndex
             outcomeTokensTraded
-            transactionHash
-            fpmm {
+            fpmm {{
                 id
-                outcomes
-                title
-                answerFinalizedTimestamp
-                currentAnswer
-                isPendingArbitration
-                arbitrationOccurred
-                openingTimestamp
-                condition {
-                    id
-                }
-            }
-        }
-    }
+            }}
+        }}
+"""
+
+
+omen_xdai_markets_query = """
+    {{
+        fixedProductMarketMakers(
+            where: {{
+                id_in: {ids}
+            }}
+            first: {first}
+        ) {{
+            id
+            outcomes
+            answerFinalizedTimestamp
+            currentAnswer
+            isPendingArbitration
+            openingTimestamp
+            condition {{
+                id
+            }}
+        }}
+        _meta {{
+            block {{
+                timestamp
+            }}
+        }}
+    }}
     """
-)
 
 
-conditional_tokens_gc_user_query = Template(
+conditional_tokens_gc_user_query = """
+    query UserPositions($userPositions_id_gt: ID!) {{
+        user(id: "{id}") {{
+{pages}
+        }}
+    }}
     """
-    {
-        user(id: "${id}") {
-            userPositions(
-                first: ${first}
-                where: {
-                    id_gt: "${userPositions_id_gt}"
-                }
+
+
+conditional_tokens_gc_user_page_query = """
+            page{page}: userPositions(
+                first: {first}
+                skip: {skip}
+                where: {{
+                    id_gt: $userPositions_id_gt
+                }}
                 orderBy: id
-            ) {
+            ) {{
                 balance
                 id
-                position {
-                    id
+                position {{
                     conditionIds
-                }
-                totalBalance
-                wrappedBalance
-            }
-        }
-    }
-    """
-)
+                }}
+            }}
+"""
 
 
 class MarketState(Enum):
@@ -205,43 +310,128 @@ class MarketAttribute(Enum):
             raise ValueError(f"Invalid MarketAttribute: {s}") from e
 
 
-STATS_TABLE_COLS = list(MarketState) + ["TOTAL"]
-STATS_TABLE_ROWS = list(MarketAttribute)
+STATS_TABLE_STATE_COLS: Tuple[MarketState, ...] = tuple(MarketState)
+STATS_TABLE_COLS: Tuple[Union[MarketState, str], ...] = STATS_TABLE_STATE_COLS + ("TOTAL",)
+STATS_TABLE_ROWS: Tuple[MarketAttribute, ...] = tuple(MarketAttribute)
+STATS_TABLE_COLUMN_WIDTH = 18
+
+# Statistics per attribute and market state (plus "TOTAL"): counts and wei amounts, or ROI ratios.
+StatisticsTable = Dict[MarketAttribute, Dict[Union[MarketState, str], Any]]
+MechStatistics = Dict[str, Dict[str, int]]
+
+
+@dataclass(frozen=True, slots=True)
+class Trade:  # pylint: disable=too-many-instance-attributes
+    """An Omen trade, with its numeric fields parsed once."""
+
+    title: str
+    creation_timestamp: float
+    collateral_amount: int
+    fee_amount: int
+    outcome_index: int
+    outcomes_tokens_traded: int
+    market: Dict[str, Any]
+    outcomes: Optional[List[str]]
+    current_answer: Optional[int]
+
+    @classmethod
+    def from_json(cls, fpmm_trade: Dict[str, Any]) -> "Trade":
+        """Parses a trade returned by the Omen subgraph."""
+        # The market metadata may be missing, which only fails the parts of the report that read it.
+        market = fpmm_trade["fpmm"]
+        current_answer = market.get("currentAnswer")
+        return cls(
+            title=fpmm_trade["title"],
+            creation_timestamp=float(fpmm_trade["creationTimestamp"]),
+            collateral_amount=int(fpmm_trade["collateralAmount"]),
+            fee_amount=int(fpmm_trade["feeAmount"]),
+            outcome_index=int(fpmm_trade["outcomeIndex"]),
+            outcomes_tokens_traded=int(fpmm_trade["outcomeTokensTraded"]),
+            market=market,
+            outcomes=market.get("outcomes"),
+            current_answer=None if current_answer is None else int(current_answer, 16),
+        )
 
+    @property
+    def condition_id(self) -> Optional[str]:
+        """The id of the market condition, if the market has one."""
+        condition = self.market.get("condition")
+        return None if condition is None else condition["id"]
 
-def get_balance(address: str, rpc_url: str) -> int:
-    """Get the native xDAI balance of an address in wei."""
-    headers = {"Content-Type": "application/json"}
-    data = {
+
+def _balance_payload(address: str) -> Dict[str, Any]:
+    return {
         "jsonrpc": "2.0",
         "method": "eth_getBalance",
         "params": [address, "latest"],
         "id": 1,
     }
-    response = requests.post(rpc_url, headers=headers, json=data)
-    return int(response.json().get("result"), 16)
 
 
-def get_token_balance(
-    gnosis_address: str, token_contract_address: str, rpc_url: str
-) -> int:
-    """Get the token balance of an address in wei."""
+def _token_balance_payload(
+    gnosis_address: str, token_contract_address: str
+) -> Dict[str, Any]:
     function_selector = "70a08231"  # function selector for balanceOf(address)
     padded_address = gnosis_address.replace("0x", "").rjust(
         64, "0"
     )  # remove '0x' and pad the address to 32 bytes
     data = function_selector + padded_address
 
-    payload = {
+    return {
         "jsonrpc": "2.0",
         "method": "eth_call",
         "params": [{"to": token_contract_address, "data": data}, "latest"],
         "id": 1,
     }
-    response = requests.post(rpc_url, json=payload)
-    result = response.json().get("result", "0x0")
-    balance_wei = int(result, 16)  # convert hex to int
-    return balance_wei
+
+
+def _rpc_post(rpc_url: str, data: Any) -> Any:
+    """Send a JSON-RPC request or batch, returning its decoded response."""
+    response = _SESSION.post(
+        rpc_url,
+        headers={"Content-Type": "application/json"},
+        data=_json_dumps(data),
+        timeout=HTTP_TIMEOUT,
+    )
+    response.raise_for_status()
+    return _json_loads(response.content)
+
+
+def _rpc_batch(rpc_url: str, payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Send JSON-RPC calls in a single batch request where possible, returning their responses in call order."""
+    batch = [{**payload, "id": i} for i, payload in enumerate(payloads)]
+    if len(batch) > 1:
+        try:
+            results = _rpc_post(rpc_url, batch)
+        except requests.HTTPError:
+            results = None
+        if isinstance(results, list):
+            # Responses to a batch may come back in any order.
+            results_by_id = {result.get("id"): result for result in results}
+            return [results_by_id.get(i, {}) for i in range(len(batch))]
+
+    # Endpoints that reject or limit batches answer with an error object instead, so the calls are sent one by one.
+    return [_rpc_post(rpc_url, call) for call in batch]
+
+
+def get_balance(address: str, rpc_url: str) -> int:
+    """Get the native xDAI balance of an address in wei."""
+    (balance,) = _rpc_batch(rpc_url, [_balance_payload(address)])
+    return int(balance["result"], 16)
+
+
+def get_balances(
+    address: str, token_contract_address: str, rpc_url: str
+) -> Tuple[int, int]:
+    """Get the native xDAI and token balances of an address in wei, in a single RPC request."""
+    balance, token_balance = _rpc_batch(
+        rpc_url,
+        [
+            _balance_payload(address),
+            _token_balance_payload(address, token_contract_address),
+        ],
+    )
+    return int(balance["result"], 16), int(token_balance.get("result", "0x0"), 16)
 
 
 class EthereumAddressAction(Action):
@@ -257,7 +447,7 @@ class EthereumAddressAction(Action):
         """Validates an Ethereum addresses."""
 
         address = values
-        if not re.match(r"^0x[a-fA-F0-9]{40}$", address):
+        if not ETHEREUM_ADDRESS_REGEX.fullmatch(address):
             raise ArgumentError(self, f"Invalid Ethereum address: {address}")
         setattr(namespace, self.dest, address)
 
@@ -312,16 +502,239 @@ def _parse_args() -> Any:
     return args
 
 
-def _to_content(q: str) -> Dict[str, Any]:
+def _to_content(q: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """Convert the given query string to payload content, i.e., add it under a `queries` key and convert it to bytes."""
     finalized_query = {
         "query": q,
-        "variables": None,
+        "variables": variables,
         "extensions": {"headers": None},
     }
     return finalized_query
 
 
+def _render_batched_query(
+    query: str, page_query: str, query_params: Dict[str, str]
+) -> str:
+    """Render a query that fetches `QUERY_BATCH_PAGES` consecutive pages under aliases."""
+    pages = "".join(
+        page_query.format_map(
+            {**query_params, "page": str(i), "skip": str(i * int(query_params["first"]))}
+        )
+        for i in range(QUERY_BATCH_PAGES)
+    )
+    return query.format_map({**query_params, "pages": pages})
+
+
+def _join_pages(pages_json: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Concatenate the aliased pages of a batched query response, in order."""
+    return [
+        item
+        for i in range(QUERY_BATCH_PAGES)
+        for item in pages_json.get(f"page{i}") or []
+    ]
+
+
+def _post_query(
+    url: str, content_json: Dict[str, Any], session: requests.Session = _SESSION
+) -> Dict[str, Any]:
+    """Post a query to a subgraph and decode the response, raising on failures and GraphQL errors."""
+    # Rate limited and failed requests are already retried by the session adapter.
+    res = session.post(
+        url, headers=headers, data=_json_dumps(content_json), timeout=HTTP_TIMEOUT
+    )
+    res.raise_for_status()
+    result_json = _json_loads(res.content)
+
+    if "errors" in result_json:
+        raise ValueError(f"Subgraph query failed: {result_json['errors']}")
+
+    return result_json
+
+
+def _cached_post(
+    url: str,
+    content_json: Dict[str, Any],
+    cache_if: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    session: requests.Session = _SESSION,
+) -> Dict[str, Any]:
+    """Post a query to a subgraph, reusing the stored response of an identical query."""
+    # Only queries with a `cache_if` are cached, and only once it confirms the response can no longer change.
+    if cache_if is None:
+        return _post_query(url, content_json, session)
+
+    # The subgraph id is part of the key, but not the API key that precedes it in the URL.
+    subgraph = url.rsplit("/subgraphs/", 1)[-1]
+    key = hashlib.sha256(
+        json.dumps([subgraph, content_json], sort_keys=True).encode()
+    ).hexdigest()
+    cache_file = Path(SUBGRAPH_CACHE_PATH, f"{key}.json")
+    try:
+        return _json_loads(cache_file.read_bytes())
+    except (FileNotFoundError, ValueError):
+        pass
+
+    result_json = _post_query(url, content_json, session)
+    if cache_if(result_json):
+        _write_atomically(cache_file, _json_dumps(result_json))
+
+    return result_json
+
+
+def _prune_subgraph_cache() -> None:
+    """Remove the cached subgraph responses older than `SUBGRAPH_CACHE_MAX_AGE`."""
+    expiry = time.time() - SUBGRAPH_CACHE_MAX_AGE
+    for cache_file in SUBGRAPH_CACHE_PATH.glob("*.json"):
+        try:
+            if cache_file.stat().st_mtime < expiry:
+                cache_file.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _indexed_timestamp(result_json: Dict[str, Any]) -> int:
+    """Get the timestamp of the latest block indexed by the subgraph that answered a query."""
+    meta = (result_json.get("data") or {}).get("_meta") or {}
+    timestamp = (meta.get("block") or {}).get("timestamp")
+    # Without it, no block is known to be indexed.
+    return DEFAULT_FROM_TIMESTAMP if timestamp is None else int(timestamp)
+
+
+def _is_indexed_past(timestamp: int, result_json: Dict[str, Any]) -> bool:
+    """Check whether a response holds data indexed well past the given timestamp."""
+    return (
+        "data" in result_json
+        and timestamp < _indexed_timestamp(result_json) - TRADES_STORE_INDEXING_MARGIN
+    )
+
+
+def _is_final_markets_page(result_json: Dict[str, Any]) -> bool:
+    """Check whether all the markets in a response are closed as of the block it is indexed up to."""
+    if "data" not in result_json:
+        return False
+
+    # A market closed by then cannot be answered again in the blocks the subgraph has not indexed yet.
+    indexed_timestamp = _indexed_timestamp(result_json) - TRADES_STORE_INDEXING_MARGIN
+    return all(
+        _get_market_state(market, indexed_timestamp) == MarketState.CLOSED
+        for market in result_json["data"].get("fixedProductMarketMakers", [])
+    )
+
+
+def _query_omen_xdai_markets(url: str, market_ids: List[str]) -> List[Dict[str, Any]]:
+    """Query the metadata of the given markets in batches."""
+    markets = []
+    for i in range(0, len(market_ids), QUERY_BATCH_SIZE):
+        query = omen_xdai_markets_query.format(
+            ids=json.dumps(market_ids[i : i + QUERY_BATCH_SIZE]),
+            first=QUERY_BATCH_SIZE,
+        )
+        content_json = _to_content(query)
+        result_json = _cached_post(url, content_json, _is_final_markets_page)
+        markets.extend(result_json.get("data", {}).get("fixedProductMarketMakers", []))
+
+    return markets
+
+
+def _query_trade_range(
+    url: str,
+    query_params: Dict[str, str],
+    cache_if: Optional[Callable[[Dict[str, Any]], bool]],
+    id_gt: str = "",
+) -> Tuple[List[Dict[str, Any]], int]:
+    """Page through the trades matching the query parameters, and the timestamp they are indexed up to."""
+    # Adapts to the subgraph load: halved on failed or slow batches, doubled back after two fast ones.
+    first = QUERY_BATCH_SIZE
+    fast_batches = 0
+    trades: List[Dict[str, Any]] = []
+    # The pages may be answered by indexers at different blocks, so the earliest one is kept.
+    indexed_timestamp = DEFAULT_TO_TIMESTAMP
+
+    def _render_query() -> str:
+        return _render_batched_query(
+            omen_xdai_trades_query,
+            omen_xdai_trades_page_query,
+            {**query_params, "first": str(first)},
+        )
+
+    # Only re-rendered when the page size changes; the cursor is passed as a variable.
+    query = _render_query()
+
+    while True:
+        content_json = _to_content(query, {"id_gt": id_gt})
+        start = time.perf_counter()
+        try:
+            result_json = _cached_post(url, content_json, cache_if, _TRADES_SESSION)
+        # Timeouts, failures and responses that are not JSON, such as overload pages;
+        # GraphQL errors would fail again with smaller pages.
+        except (requests.RequestException, json.JSONDecodeError):
+            if first <= QUERY_MIN_BATCH_SIZE:
+                raise
+            # Retry the same batch with smaller pages.
+            first = max(first // 2, QUERY_MIN_BATCH_SIZE)
+            fast_batches = 0
+            query = _render_query()
+            continue
+        elapsed = time.perf_counter() - start
+
+        batch = _join_pages(result_json.get("data", {}))
+        trades.extend(batch)
+        indexed_timestamp = min(indexed_timestamp, _indexed_timestamp(result_json))
+
+        if len(batch) < first * QUERY_BATCH_PAGES:
+            return trades, indexed_timestamp
+
+        previous_first = first
+        fast_batches = fast_batches + 1 if elapsed < QUERY_FAST_RESPONSE_TIME else 0
+        if elapsed > QUERY_SLOW_RESPONSE_TIME:
+            first = max(first // 2, QUERY_MIN_BATCH_SIZE)
+        elif fast_batches == 2:
+            first = min(first * 2, QUERY_BATCH_SIZE)
+            fast_batches = 0
+        if first != previous_first:
+            query = _render_query()
+        id_gt = batch[-1]["id"]
+
+
+def _attach_markets(
+    url: str, trades: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """Attach the metadata of its market to a copy of each trade."""
+    # Fetched once per market, rather than once per trade.
+    market_ids = list(dict.fromkeys(trade["fpmm"]["id"] for trade in trades))
+    markets = {
+        market["id"]: market for market in _query_omen_xdai_markets(url, market_ids)
+    }
+    return [
+        {**trade, "fpmm": markets.get(trade["fpmm"]["id"], trade["fpmm"])}
+        for trade in trades
+    ]
+
+
+def _write_atomically(path: Path, data: bytes) -> None:
+    """Write a file through a temporary one, so that it is never left partially written."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as file:
+        file.write(data)
+    os.replace(file.name, path)
+
+
+def _load_stored_trades(creator: str) -> Tuple[int, List[Dict[str, Any]]]:
+    """Load the stored trades of a creator, and the timestamp up to which they are complete."""
+    try:
+        stored = _json_loads(Path(TRADES_STORE_PATH, f"{creator}.json").read_bytes())
+        return stored["until"], stored["trades"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return DEFAULT_FROM_TIMESTAMP - 1, []
+
+
+def _save_stored_trades(creator: str, until: int, trades: List[Dict[str, Any]]) -> None:
+    """Store the trades of a creator, complete up to the given timestamp."""
+    _write_atomically(
+        Path(TRADES_STORE_PATH, f"{creator}.json"),
+        _json_dumps({"until": until, "trades": trades}),
+    )
+
+
 def _query_omen_xdai_subgraph(  # pylint: disable=too-many-locals
     creator: str,
     from_timestamp: float = DEFAULT_FROM_TIMESTAMP,
@@ -329,47 +742,91 @@ def _query_omen_xdai_subgraph(  # pylint: disable=too-many-locals
     fpmm_from_timestamp: float = DEFAULT_FROM_TIMESTAMP,
     fpmm_to_timestamp: float = DEFAULT_TO_TIMESTAMP,
 ) -> Dict[str, Any]:
-    """Query the subgraph."""
+    """Query the subgraph for the trades of a creator, with the metadata of their markets."""
     subgraph_api_key = os.getenv('SUBGRAPH_API_KEY')
     url = f"https://gateway-arbitrum.network.thegraph.com/api/{subgraph_api_key}/subgraphs/id/9fUVQpFwzpdWS9bq5WkAnmKbNNcoBwatMR4yZq81pbbz"
 
-    grouped_results = defaultdict(list)
-    creationTimestamp_gt = "0"
+    creator = creator.lower()
+    from_timestamp = int(from_timestamp)
+    to_timestamp = int(to_timestamp)
+    # Trades never change once indexed, so they are stored up to a recent timestamp and only the
+    # ones after it are queried on later runs. The stored trades lack the market creation timestamps.
+    use_store = (
+        fpmm_from_timestamp == DEFAULT_FROM_TIMESTAMP
+        and fpmm_to_timestamp == DEFAULT_TO_TIMESTAMP
+    )
+    stored_until, stored_trades = (
+        _load_stored_trades(creator) if use_store else (DEFAULT_FROM_TIMESTAMP - 1, [])
+    )
+    now = int(time.time())
+    # Trades of a past time window never change once the subgraph has indexed past it, unlike the
+    # metadata of their markets. A window that is not even past by the clock is not looked up.
+    cache_if = None
+    if to_timestamp < now - TRADES_STORE_INDEXING_MARGIN:
+        cache_if = functools.partial(_is_indexed_past, to_timestamp)
+    _prune_subgraph_cache()
+
+    # Only the id range and the pagination cursor change from one page to the next.
+    query_params = {
+        "creator": creator,
+        "fpmm_creator": FPMM_CREATOR.lower(),
+        "creationTimestamp_gte": str(max(from_timestamp, stored_until + 1)),
+        "creationTimestamp_lte": str(to_timestamp),
+        "fpmm_creationTimestamp_gte": str(int(fpmm_from_timestamp)),
+        "fpmm_creationTimestamp_lte": str(int(fpmm_to_timestamp)),
+    }
 
-    while True:
-        query = omen_xdai_trades_query.substitute(
-            creator=creator.lower(),
-            fpmm_creator=FPMM_CREATOR.lower(),
-            creationTimestamp_gte=int(from_timestamp),
-            creationTimestamp_lte=int(to_timestamp),
-            fpmm_creationTimestamp_gte=int(fpmm_from_timestamp),
-            fpmm_creationTimestamp_lte=int(fpmm_to_timestamp),
-            first=QUERY_BATCH_SIZE,
-            creationTimestamp_gt=creationTimestamp_gt,
+    # Each id range is paged in its own background task, so that the ranges are paged concurrently.
+    fetched_trades: List[Dict[str, Any]] = []
+    indexed_timestamp = stored_until
+    if to_timestamp > stored_until:
+        id_ranges = [
+            _EXECUTOR.submit(
+                _query_trade_range,
+                url,
+                {**query_params, "id_lt": id_lt},
+                cache_if,
+                id_gt,
+            )
+            for id_gt, id_lt in zip(QUERY_ID_RANGE_BOUNDS, QUERY_ID_RANGE_BOUNDS[1:])
+        ]
+        indexed_timestamps = []
+        for id_range in id_ranges:
+            range_trades, range_indexed_timestamp = id_range.result()
+            fetched_trades.extend(range_trades)
+            indexed_timestamps.append(range_indexed_timestamp)
+        indexed_timestamp = min(indexed_timestamps)
+
+    in_window = (
+        trade
+        for trade in stored_trades
+        if from_timestamp <= int(trade["creationTimestamp"]) <= to_timestamp
+    )
+    # Paged by id, but listed in creation order, as the report prints them.
+    window_trades = sorted(
+        itertools.chain(in_window, fetched_trades),
+        key=lambda trade: (int(trade["creationTimestamp"]), trade["id"]),
+    )
+    all_results = {"data": {"fpmmTrades": _attach_markets(url, window_trades)}}
+
+    # Extend the store only up to a block that every range was indexed past, and only if
+    # the query carried on right where it ended.
+    store_until = min(now - TRADES_STORE_INDEXING_MARGIN, indexed_timestamp)
+    if (
+        use_store
+        and from_timestamp <= stored_until + 1
+        and stored_until < store_until <= to_timestamp
+    ):
+        new_trades = [
+            trade
+            for trade in fetched_trades
+            if int(trade["creationTimestamp"]) <= store_until
+        ]
+        _save_stored_trades(
+            creator,
+            store_until,
+            sorted(stored_trades + new_trades, key=lambda trade: trade["id"]),
         )
-        content_json = _to_content(query)
-        res = requests.post(url, headers=headers, json=content_json)
-        result_json = res.json()
-        trades = result_json.get("data", {}).get("fpmmTrades", [])
-
-        if not trades:
-            break
-
-        for trade in trades:
-            fpmm_id = trade.get("fpmm", {}).get("id")
-            grouped_results[fpmm_id].append(trade)
-
-        creationTimestamp_gt = trades[len(trades) - 1]["creationTimestamp"]
-
-    all_results = {
-        "data": {
-            "fpmmTrades": [
-                trade
-                for trades_list in grouped_results.values()
-                for trade in trades_list
-            ]
-        }
-    }
 
     return all_results
 
@@ -380,27 +837,28 @@ def _query_conditional_tokens_gc_subgraph(creator: str) -> Dict[str, Any]:
     url = f"https://gateway-arbitrum.network.thegraph.com/api/{subgraph_api_key}/subgraphs/id/7s9rGBffUTL8kDZuxvvpuc46v44iuDarbrADBFw5uVp2"
 
     all_results: Dict[str, Any] = {"data": {"user": {"userPositions": []}}}
-    userPositions_id_gt = ""
+    # Rendered once; only the cursor changes from one batch to the next.
+    query = _render_batched_query(
+        conditional_tokens_gc_user_query,
+        conditional_tokens_gc_user_page_query,
+        {"id": creator.lower(), "first": str(QUERY_BATCH_SIZE)},
+    )
+    variables = {"userPositions_id_gt": ""}
     while True:
-        query = conditional_tokens_gc_user_query.substitute(
-            id=creator.lower(),
-            first=QUERY_BATCH_SIZE,
-            userPositions_id_gt=userPositions_id_gt,
-        )
-        content_json = {"query": query}
-        res = requests.post(url, headers=headers, json=content_json)
-        result_json = res.json()
+        content_json = _to_content(query, variables)
+        result_json = _post_query(url, content_json)
         user_data = result_json.get("data", {}).get("user", {})
 
         if not user_data:
             break
 
-        user_positions = user_data.get("userPositions", [])
+        user_positions = _join_pages(user_data)
 
         if user_positions:
             all_results["data"]["user"]["userPositions"].extend(user_positions)
-            userPositions_id_gt = user_positions[len(user_positions) - 1]["id"]
-        else:
+            variables = {"userPositions_id_gt": user_positions[-1]["id"]}
+
+        if len(user_positions) < QUERY_BATCH_SIZE * QUERY_BATCH_PAGES:
             break
 
     if len(all_results["data"]["user"]["userPositions"]) == 0:
@@ -411,9 +869,11 @@ def _query_conditional_tokens_gc_subgraph(creator: str) -> Dict[str, Any]:
 
 def wei_to_unit(wei: int) -> float:
     """Converts wei to currency unit."""
-    return wei / 10**18
+    return wei / WEI_IN_UNIT
 
 
+# Amounts repeat a lot across trades (e.g., fixed bet sizes and fees) and table cells.
+@functools.lru_cache(maxsize=8192)
 def wei_to_xdai(wei: int) -> str:
     """Converts and formats wei to xDAI."""
     return "{:.2f} xDAI".format(wei_to_unit(wei))
@@ -429,26 +889,32 @@ def wei_to_olas(wei: int) -> str:
     return "{:.2f} OLAS".format(wei_to_unit(wei))
 
 
-def _is_redeemed(user_json: Dict[str, Any], fpmmTrade: Dict[str, Any]) -> bool:
-    user_positions = user_json["data"]["user"]["userPositions"]
-    outcomes_tokens_traded = int(fpmmTrade["outcomeTokensTraded"])
-    condition_id = fpmmTrade["fpmm"]["condition"]["id"]
+def _index_balances_by_condition(user_json: Dict[str, Any]) -> Dict[str, Set[int]]:
+    """Index the distinct balances of the user positions by their condition ids."""
+    balances_by_condition: Dict[str, Set[int]] = defaultdict(set)
+    user_data = user_json["data"]["user"] or {}
 
-    for position in user_positions:
-        position_condition_ids = position["position"]["conditionIds"]
+    for position in user_data.get("userPositions", []):
         balance = int(position["balance"])
+        for condition_id in position["position"]["conditionIds"]:
+            balances_by_condition[condition_id].add(balance)
 
-        if condition_id in position_condition_ids and balance == outcomes_tokens_traded:
-            return False
+    return balances_by_condition
 
-    for position in user_positions:
-        position_condition_ids = position["position"]["conditionIds"]
-        balance = int(position["balance"])
 
-        if condition_id in position_condition_ids and balance == 0:
-            return True
+def _query_balances_by_condition(creator: str) -> Dict[str, Set[int]]:
+    """Query the user positions and index their balances by condition id."""
+    return _index_balances_by_condition(_query_conditional_tokens_gc_subgraph(creator))
+
 
-    return False
+def _is_redeemed(balances_by_condition: Dict[str, Set[int]], trade: Trade) -> bool:
+    condition_id = trade.condition_id
+    balances = None if condition_id is None else balances_by_condition.get(condition_id)
+    if not balances:
+        # Nothing can have been redeemed without a position on the market.
+        return False
+
+    return 0 in balances and trade.outcomes_tokens_traded not in balances
 
 
 def _compute_roi(initial_value: int, final_value: int) -> float:
@@ -460,63 +926,56 @@ def _compute_roi(initial_value: int, final_value: int) -> float:
     return roi
 
 
-def _compute_totals(
-    table: Dict[Any, Dict[Any, Any]], mech_statistics: Dict[str, Any]
-) -> None:
-    for row in table.keys():
-        total = sum(table[row][c] for c in table[row])
-        table[row]["TOTAL"] = total
+def _compute_totals(table: StatisticsTable, mech_statistics: MechStatistics) -> None:
+    for row in table.values():
+        row["TOTAL"] = sum(row[state] for state in STATS_TABLE_STATE_COLS)
 
     # Total mech fees and calls need to be recomputed, because there could be mech calls
     # for markets that were not traded
-    total_mech_calls = 0
-    total_mech_fees = 0
-
-    for _, v in mech_statistics.items():
+    total_mech_calls = total_mech_fees = 0
+    for v in mech_statistics.values():
         total_mech_calls += v["count"]
         total_mech_fees += v["fees"]
-
     table[MarketAttribute.MECH_CALLS]["TOTAL"] = total_mech_calls
     table[MarketAttribute.MECH_FEES]["TOTAL"] = total_mech_fees
 
+    investment = table[MarketAttribute.INVESTMENT]
+    fees = table[MarketAttribute.FEES]
+    mech_fees = table[MarketAttribute.MECH_FEES]
+    earnings = table[MarketAttribute.EARNINGS]
+    net_earnings = table[MarketAttribute.NET_EARNINGS]
+    roi = table[MarketAttribute.ROI]
+
     for col in STATS_TABLE_COLS:
+        col_fees = fees[col]
+        col_mech_fees = mech_fees[col]
+        col_earnings = earnings[col]
         # Omen deducts the fee from collateral_amount (INVESTMENT) to compute outcomes_tokens_traded (EARNINGS).
-        table[MarketAttribute.INVESTMENT][col] = (
-            table[MarketAttribute.INVESTMENT][col] - table[MarketAttribute.FEES][col]
-        )
-        table[MarketAttribute.NET_EARNINGS][col] = (
-            table[MarketAttribute.EARNINGS][col]
-            - table[MarketAttribute.INVESTMENT][col]
-            - table[MarketAttribute.FEES][col]
-            - table[MarketAttribute.MECH_FEES][col]
-        )
+        col_investment = investment[col] - col_fees
+        investment[col] = col_investment
+        net_earnings[col] = col_earnings - col_investment - col_fees - col_mech_fees
         # ROI is recomputed here for all columns, including TOTAL.
-        table[MarketAttribute.ROI][col] = _compute_roi(
-            table[MarketAttribute.INVESTMENT][col]
-            + table[MarketAttribute.FEES][col]
-            + table[MarketAttribute.MECH_FEES][col],
-            table[MarketAttribute.EARNINGS][col],
-        )
+        roi[col] = _compute_roi(col_investment + col_fees + col_mech_fees, col_earnings)
 
 
-def _get_market_state(market: Dict[str, Any]) -> MarketState:
+def _get_market_state(
+    market: Dict[str, Any], now: Optional[float] = None
+) -> MarketState:
     try:
-        now = datetime.datetime.utcnow()
+        # Timestamps are compared as seconds since the epoch, without building datetimes.
+        if now is None:
+            now = time.time()
 
         market_state = MarketState.CLOSED
-        if market[
-            "currentAnswer"
-        ] is None and now >= datetime.datetime.utcfromtimestamp(
-            float(market.get("openingTimestamp", 0))
+        if market["currentAnswer"] is None and now >= float(
+            market.get("openingTimestamp", 0)
         ):
             market_state = MarketState.PENDING
         elif market["currentAnswer"] is None:
             market_state = MarketState.OPEN
         elif market["isPendingArbitration"]:
             market_state = MarketState.ARBITRATING
-        elif now < datetime.datetime.utcfromtimestamp(
-            float(market.get("answerFinalizedTimestamp", 0))
-        ):
+        elif now < float(market.get("answerFinalizedTimestamp", 0)):
             market_state = MarketState.FINALIZING
 
         return market_state
@@ -524,329 +983,237 @@ def _get_market_state(market: Dict[str, Any]) -> MarketState:
         return MarketState.UNKNOWN
 
 
-def _format_table(table: Dict[Any, Dict[Any, Any]]) -> str:
-    column_width = 18
+def _format_roi(roi: float) -> str:
+    return f"{roi*100.0:>{STATS_TABLE_COLUMN_WIDTH-5}.2f} %   "
+
+
+# Rows of the statistics table, in display order, with the formatter of their cells.
+STATS_TABLE_FORMATTERS: List[Tuple[MarketAttribute, Callable[[Any], str]]] = [
+    (MarketAttribute.NUM_TRADES, str),
+    (MarketAttribute.NUM_VALID_TRADES, str),
+    (MarketAttribute.WINNER_TRADES, str),
+    (MarketAttribute.NUM_REDEEMED, str),
+    (MarketAttribute.NUM_INVALID_MARKET, str),
+    (MarketAttribute.MECH_CALLS, str),
+    (MarketAttribute.INVESTMENT, wei_to_xdai),
+    (MarketAttribute.FEES, wei_to_xdai),
+    (MarketAttribute.MECH_FEES, wei_to_xdai),
+    (MarketAttribute.EARNINGS, wei_to_xdai),
+    (MarketAttribute.NET_EARNINGS, wei_to_xdai),
+    (MarketAttribute.REDEMPTIONS, wei_to_xdai),
+    (MarketAttribute.ROI, _format_roi),
+]
 
-    table_str = " " * column_width
 
-    for col in STATS_TABLE_COLS:
-        table_str += f"{col:>{column_width}}"
-
-    table_str += "\n"
-    table_str += "-" * column_width * (len(STATS_TABLE_COLS) + 1) + "\n"
-
-    table_str += (
-        f"{MarketAttribute.NUM_TRADES:<{column_width}}"
-        + "".join(
-            [
-                f"{table[MarketAttribute.NUM_TRADES][c]:>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.NUM_VALID_TRADES:<{column_width}}"
-        + "".join(
-            [
-                f"{table[MarketAttribute.NUM_VALID_TRADES][c]:>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.WINNER_TRADES:<{column_width}}"
-        + "".join(
-            [
-                f"{table[MarketAttribute.WINNER_TRADES][c]:>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.NUM_REDEEMED:<{column_width}}"
-        + "".join(
-            [
-                f"{table[MarketAttribute.NUM_REDEEMED][c]:>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.NUM_INVALID_MARKET:<{column_width}}"
-        + "".join(
-            [
-                f"{table[MarketAttribute.NUM_INVALID_MARKET][c]:>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.MECH_CALLS:<{column_width}}"
-        + "".join(
-            [
-                f"{table[MarketAttribute.MECH_CALLS][c]:>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.INVESTMENT:<{column_width}}"
-        + "".join(
-            [
-                f"{wei_to_xdai(table[MarketAttribute.INVESTMENT][c]):>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.FEES:<{column_width}}"
-        + "".join(
-            [
-                f"{wei_to_xdai(table[MarketAttribute.FEES][c]):>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.MECH_FEES:<{column_width}}"
-        + "".join(
-            [
-                f"{wei_to_xdai(table[MarketAttribute.MECH_FEES][c]):>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.EARNINGS:<{column_width}}"
-        + "".join(
-            [
-                f"{wei_to_xdai(table[MarketAttribute.EARNINGS][c]):>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.NET_EARNINGS:<{column_width}}"
-        + "".join(
-            [
-                f"{wei_to_xdai(table[MarketAttribute.NET_EARNINGS][c]):>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.REDEMPTIONS:<{column_width}}"
-        + "".join(
-            [
-                f"{wei_to_xdai(table[MarketAttribute.REDEMPTIONS][c]):>{column_width}}"
-                for c in STATS_TABLE_COLS
-            ]
-        )
-        + "\n"
-    )
-    table_str += (
-        f"{MarketAttribute.ROI:<{column_width}}"
-        + "".join(
-            [
-                f"{table[MarketAttribute.ROI][c]*100.0:>{column_width-5}.2f} %   "
-                for c in STATS_TABLE_COLS
-            ]
+# Every line of the table has the same layout, so its format string is built once.
+STATS_TABLE_ROW_FORMAT = (
+    f"{{:<{STATS_TABLE_COLUMN_WIDTH}}}"
+    + f"{{:>{STATS_TABLE_COLUMN_WIDTH}}}" * len(STATS_TABLE_COLS)
+    + "\n"
+)
+# The column titles and separator line do not depend on the statistics.
+STATS_TABLE_HEADER = (
+    STATS_TABLE_ROW_FORMAT.format("", *STATS_TABLE_COLS)
+    + "-" * STATS_TABLE_COLUMN_WIDTH * (len(STATS_TABLE_COLS) + 1)
+    + "\n"
+)
+
+
+def _format_table(table: StatisticsTable) -> str:
+    parts = [STATS_TABLE_HEADER]
+
+    for attribute, formatter in STATS_TABLE_FORMATTERS:
+        row = table[attribute]
+        parts.append(
+            STATS_TABLE_ROW_FORMAT.format(
+                attribute, *[formatter(row[col]) for col in STATS_TABLE_COLS]
+            )
         )
-        + "\n"
-    )
 
-    return table_str
+    return "".join(parts)
 
 
 def parse_user(  # pylint: disable=too-many-locals,too-many-statements
     rpc: str,
     creator: str,
     creator_trades_json: Dict[str, Any],
-    mech_statistics: Dict[str, Any],
-) -> tuple[str, Dict[Any, Any]]:
+    mech_statistics: MechStatistics,
+) -> tuple[str, StatisticsTable]:
     """Parse the trades from the response."""
 
     _mech_statistics = dict(mech_statistics)
-    user_json = _query_conditional_tokens_gc_subgraph(creator)
+    # Only needed for trades on closed markets, so only queried once the first one is seen.
+    balances_future: Optional["Future[Dict[str, Set[int]]]"] = None
+    # Read in the background while the trades are being queried and parsed.
+    safe_balances_future = _EXECUTOR.submit(
+        get_balances, creator, WXDAI_CONTRACT_ADDRESS, rpc
+    )
 
-    statistics_table = {
-        row: {col: 0 for col in STATS_TABLE_COLS} for row in STATS_TABLE_ROWS
+    statistics_table: StatisticsTable = {
+        row: dict.fromkeys(STATS_TABLE_COLS, 0) for row in STATS_TABLE_ROWS
     }
-
-    output = "------\n"
-    output += "Trades\n"
-    output += "------\n"
-
+    # Bind the rows once, so that each update in the loop is a single lookup.
+    num_trades_stats = statistics_table[MarketAttribute.NUM_TRADES]
+    num_valid_trades_stats = statistics_table[MarketAttribute.NUM_VALID_TRADES]
+    winner_trades_stats = statistics_table[MarketAttribute.WINNER_TRADES]
+    num_redeemed_stats = statistics_table[MarketAttribute.NUM_REDEEMED]
+    num_invalid_market_stats = statistics_table[MarketAttribute.NUM_INVALID_MARKET]
+    investment_stats = statistics_table[MarketAttribute.INVESTMENT]
+    fees_stats = statistics_table[MarketAttribute.FEES]
+    mech_calls_stats = statistics_table[MarketAttribute.MECH_CALLS]
+    mech_fees_stats = statistics_table[MarketAttribute.MECH_FEES]
+    earnings_stats = statistics_table[MarketAttribute.EARNINGS]
+    redemptions_stats = statistics_table[MarketAttribute.REDEMPTIONS]
+
+    parts = ["------\nTrades\n------\n"]
+
+    # The market states are evaluated at a single point in time for the whole report,
+    # so each market's state is only evaluated for its first trade.
+    now = time.time()
+    market_states: Dict[str, MarketState] = {}
     for fpmmTrade in creator_trades_json["data"]["fpmmTrades"]:
         try:
-            collateral_amount = int(fpmmTrade["collateralAmount"])
-            outcome_index = int(fpmmTrade["outcomeIndex"])
-            fee_amount = int(fpmmTrade["feeAmount"])
-            outcomes_tokens_traded = int(fpmmTrade["outcomeTokensTraded"])
-            creation_timestamp = float(fpmmTrade["creationTimestamp"])
+            trade = Trade.from_json(fpmmTrade)
+            collateral_amount = trade.collateral_amount
+            outcomes_tokens_traded = trade.outcomes_tokens_traded
+            # Indexing raises the TypeError reported below when the market metadata is missing.
+            outcomes: List[str] = trade.outcomes  # type: ignore
 
-            fpmm = fpmmTrade["fpmm"]
+            parts.append(f"      Question: {trade.title}\n")
+            parts.append(f'    Market URL: https://aiomen.eth.limo/#/{trade.market["id"]}\n')
 
-            output += f'      Question: {fpmmTrade["title"]}\n'
-            output += f'    Market URL: https://aiomen.eth.limo/#/{fpmm["id"]}\n'
-
-            creation_timestamp_utc = datetime.datetime.fromtimestamp(
-                creation_timestamp, tz=datetime.timezone.utc
+            dt = datetime.datetime.fromtimestamp(
+                trade.creation_timestamp, tz=datetime.timezone.utc
             )
-            output += f'    Trade date: {creation_timestamp_utc.strftime("%Y-%m-%d %H:%M:%S %Z")}\n'
-
-            market_status = _get_market_state(fpmm)
-
-            statistics_table[MarketAttribute.NUM_TRADES][market_status] += 1
-            statistics_table[MarketAttribute.INVESTMENT][
-                market_status
-            ] += collateral_amount
-            statistics_table[MarketAttribute.FEES][market_status] += fee_amount
-            mech_data = _mech_statistics.pop(fpmmTrade["title"], {})
-            statistics_table[MarketAttribute.MECH_CALLS][
-                market_status
-            ] += mech_data.get("count", 0)
-            mech_fees = mech_data.get("fees", 0)
-            statistics_table[MarketAttribute.MECH_FEES][market_status] += mech_fees
-
-            output += f" Market status: {market_status}\n"
-            output += f"        Bought: {wei_to_xdai(collateral_amount)} for {wei_to_xdai(outcomes_tokens_traded)} {fpmm['outcomes'][outcome_index]!r} tokens\n"
-            output += f"           Fee: {wei_to_xdai(fee_amount)}\n"
-            output += f"   Your answer: {fpmm['outcomes'][outcome_index]!r}\n"
+            parts.append(f"    Trade date: {dt.year:04d}-{dt.month:02d}-{dt.day:02d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d} UTC\n")
+
+            market_status = market_states.get(trade.market["id"])
+            if market_status is None:
+                market_status = _get_market_state(trade.market, now)
+                market_states[trade.market["id"]] = market_status
+
+            num_trades_stats[market_status] += 1
+            investment_stats[market_status] += collateral_amount
+            fees_stats[market_status] += trade.fee_amount
+            mech_data = _mech_statistics.pop(trade.title, {})
+            mech_calls_stats[market_status] += mech_data.get("count", 0)
+            mech_fees_stats[market_status] += mech_data.get("fees", 0)
+
+            parts.append(f" Market status: {market_status}\n")
+            parts.append(f"        Bought: {wei_to_xdai(collateral_amount)} for {wei_to_xdai(outcomes_tokens_traded)} {outcomes[trade.outcome_index]!r} tokens\n")
+            parts.append(f"           Fee: {wei_to_xdai(trade.fee_amount)}\n")
+            parts.append(f"   Your answer: {outcomes[trade.outcome_index]!r}\n")
 
             if market_status == MarketState.FINALIZING:
-                current_answer = int(fpmm["currentAnswer"], 16)  # type: ignore
+                current_answer: int = trade.current_answer  # type: ignore
                 is_invalid = current_answer == INVALID_ANSWER
 
                 if is_invalid:
                     earnings = collateral_amount
-                    output += "Current answer: Market has been declared invalid.\n"
-                elif outcome_index == current_answer:
+                    parts.append("Current answer: Market has been declared invalid.\n")
+                elif trade.outcome_index == current_answer:
                     earnings = outcomes_tokens_traded
-                    output += f"Current answer: {fpmm['outcomes'][current_answer]!r}\n"
-                    statistics_table[MarketAttribute.WINNER_TRADES][market_status] += 1
+                    parts.append(f"Current answer: {outcomes[current_answer]!r}\n")
+                    winner_trades_stats[market_status] += 1
                 else:
                     earnings = 0
-                    output += f"Current answer: {fpmm['outcomes'][current_answer]!r}\n"
+                    parts.append(f"Current answer: {outcomes[current_answer]!r}\n")
 
-                statistics_table[MarketAttribute.EARNINGS][market_status] += earnings
+                earnings_stats[market_status] += earnings
 
             elif market_status == MarketState.CLOSED:
-                current_answer = int(fpmm["currentAnswer"], 16)  # type: ignore
+                if balances_future is None:
+                    balances_future = _EXECUTOR.submit(
+                        _query_balances_by_condition, creator
+                    )
+                current_answer = trade.current_answer  # type: ignore
                 is_invalid = current_answer == INVALID_ANSWER
 
                 if is_invalid:
                     earnings = collateral_amount
-                    output += "  Final answer: Market has been declared invalid.\n"
-                    output += f"      Earnings: {wei_to_xdai(earnings)}\n"
-                    redeemed = _is_redeemed(user_json, fpmmTrade)
+                    parts.append("  Final answer: Market has been declared invalid.\n")
+                    parts.append(f"      Earnings: {wei_to_xdai(earnings)}\n")
+                    redeemed = _is_redeemed(balances_future.result(), trade)
                     if redeemed:
-                        statistics_table[MarketAttribute.NUM_INVALID_MARKET][
-                            market_status
-                        ] += 1
-                        statistics_table[MarketAttribute.REDEMPTIONS][
-                            market_status
-                        ] += earnings
-
-                elif outcome_index == current_answer:
+                        num_invalid_market_stats[market_status] += 1
+                        redemptions_stats[market_status] += earnings
+
+                elif trade.outcome_index == current_answer:
                     earnings = outcomes_tokens_traded
-                    output += f"  Final answer: {fpmm['outcomes'][current_answer]!r} - Congrats! The trade was for the winner answer.\n"
-                    output += f"      Earnings: {wei_to_xdai(earnings)}\n"
-                    redeemed = _is_redeemed(user_json, fpmmTrade)
-                    output += f"      Redeemed: {redeemed}\n"
-                    statistics_table[MarketAttribute.WINNER_TRADES][market_status] += 1
+                    parts.append(f"  Final answer: {outcomes[current_answer]!r} - Congrats! The trade was for the winner answer.\n")
+                    parts.append(f"      Earnings: {wei_to_xdai(earnings)}\n")
+                    redeemed = _is_redeemed(balances_future.result(), trade)
+                    parts.append(f"      Redeemed: {redeemed}\n")
+                    winner_trades_stats[market_status] += 1
 
                     if redeemed:
-                        statistics_table[MarketAttribute.NUM_REDEEMED][
-                            market_status
-                        ] += 1
-                        statistics_table[MarketAttribute.REDEMPTIONS][
-                            market_status
-                        ] += earnings
+                        num_redeemed_stats[market_status] += 1
+                        redemptions_stats[market_status] += earnings
                 else:
                     earnings = 0
-                    output += f"  Final answer: {fpmm['outcomes'][current_answer]!r} - The trade was for the loser answer.\n"
+                    parts.append(f"  Final answer: {outcomes[current_answer]!r} - The trade was for the loser answer.\n")
 
-
-                statistics_table[MarketAttribute.EARNINGS][
-                        market_status
-                    ] += earnings
-                
-                statistics_table[MarketAttribute.NUM_VALID_TRADES][
-                        market_status
-                    ] = statistics_table[MarketAttribute.NUM_TRADES][
-                        market_status
-                    ] - statistics_table[MarketAttribute.NUM_INVALID_MARKET][
-                        market_status
-                    ]
+                earnings_stats[market_status] += earnings
 
                 if 0 < earnings < DUST_THRESHOLD:
-                    output += "Earnings are dust.\n"
+                    parts.append("Earnings are dust.\n")
 
-            output += "\n"
+            parts.append("\n")
         except TypeError:
-            output += "ERROR RETRIEVING TRADE INFORMATION.\n\n"
+            parts.append("ERROR RETRIEVING TRADE INFORMATION.\n\n")
 
-    output += "\n"
-    output += "--------------------------\n"
-    output += "Summary (per market state)\n"
-    output += "--------------------------\n"
-    output += "\n"
+    # Derived once from the per-state counters, rather than on every closed trade.
+    num_valid_trades_stats[MarketState.CLOSED] = (
+        num_trades_stats[MarketState.CLOSED]
+        - num_invalid_market_stats[MarketState.CLOSED]
+    )
 
-    # Read rpc and get safe address balance
-    safe_address_balance = get_balance(creator, rpc)
+    parts.append(
+        "\n"
+        "--------------------------\n"
+        "Summary (per market state)\n"
+        "--------------------------\n"
+        "\n"
+    )
 
-    output += f"Safe address:    {creator}\n"
-    output += f"Address balance: {wei_to_xdai(safe_address_balance)}\n"
+    safe_address_balance, wxdai_balance = safe_balances_future.result()
 
-    wxdai_balance = get_token_balance(creator, WXDAI_CONTRACT_ADDRESS, rpc)
-    output += f"Token balance:   {wei_to_wxdai(wxdai_balance)}\n\n"
+    parts.append(f"Safe address:    {creator}\n")
+    parts.append(f"Address balance: {wei_to_xdai(safe_address_balance)}\n")
+    parts.append(f"Token balance:   {wei_to_wxdai(wxdai_balance)}\n\n")
 
     _compute_totals(statistics_table, mech_statistics)
-    output += _format_table(statistics_table)
+    parts.append(_format_table(statistics_table))
 
-    return output, statistics_table
+    return "".join(parts), statistics_table
 
 
-def get_mech_statistics(mech_requests: Dict[str, Any]) -> Dict[str, Dict[str, int]]:
+def get_mech_statistics(mech_requests: Dict[str, Any]) -> MechStatistics:
     """Outputs a table with Mech statistics"""
 
-    mech_statistics: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    mech_statistics: MechStatistics = defaultdict(lambda: defaultdict(int))
 
     for mech_request in mech_requests.values():
+        ipfs_contents = mech_request.get("ipfs_contents")
         if (
-            "ipfs_contents" not in mech_request
-            or "tool" not in mech_request["ipfs_contents"]
-            or "prompt" not in mech_request["ipfs_contents"]
+            ipfs_contents is None
+            or "tool" not in ipfs_contents
+            or "prompt" not in ipfs_contents
+            or ipfs_contents["tool"] in IRRELEVANT_TOOLS
         ):
             continue
 
-        if mech_request["ipfs_contents"]["tool"] in IRRELEVANT_TOOLS:
-            continue
-
-        prompt = mech_request["ipfs_contents"]["prompt"]
-        prompt = prompt.replace("\n", " ")
-        prompt = prompt.strip()
-        prompt = re.sub(r"\s+", " ", prompt)
-        prompt_match = re.search(r"\"(.*)\"", prompt)
+        # Collapse all whitespace runs, including newlines, into single spaces.
+        prompt = " ".join(ipfs_contents["prompt"].split())
+        prompt_match = QUOTED_TEXT_REGEX.search(prompt)
         if prompt_match:
             question = prompt_match.group(1)
         else:
             question = prompt
 
-        mech_statistics[question]["count"] += 1
-        mech_statistics[question]["fees"] += mech_request["fee"]
+        question_statistics = mech_statistics[question]
+        question_statistics["count"] += 1
+        question_statistics["fees"] += mech_request["fee"]
 
     return mech_statistics
 